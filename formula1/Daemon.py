@@ -0,0 +1,138 @@
+# Copyright (C) 2025 eHonnef <contact@honnef.net>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+import argparse
+import json
+import logging
+import os
+import time
+from collections import deque
+
+import requests
+
+import Fetchnator
+from Generator import Generator, generator_logger
+
+LOG_LEVEL = logging.INFO
+logging.basicConfig(level=LOG_LEVEL, format='%(levelname)-8s :: %(message)s')
+
+daemon_logger = logging.getLogger("Daemon")
+
+
+class Daemon:
+    def __init__(self, config: dict) -> None:
+        """
+        Serves several libraries from one process. All of them share one Fetchnator, so the seasons, descriptions and
+        posters are downloaded (and converted) once per host instead of once per library.
+        :param config: The daemon configuration, check the README.md file for the expected keys.
+        """
+        if config.get("cache_folder") is None:
+            raise ValueError("The daemon needs a cache_folder, it is where the libraries share the posters")
+        if config.get("warm_up") is not None and not isinstance(config["warm_up"], int):
+            raise ValueError(f"warm_up must be a number of days, got {config['warm_up']}")
+
+        self.interval = config.get("interval", 900)
+        self.warm_up_days = config.get("warm_up")
+        self.fetchnator = self._connect(config)
+
+        self.generators = []
+        for library in config["libraries"]:
+            conversion = Fetchnator.ImageConvertor.DONT
+            if library.get("convert_to_jpg", False):
+                conversion = Fetchnator.ImageConvertor.JPG
+            self.generators.append(Generator(library["basefolder"],
+                                             library.get("mapped_folder", library["basefolder"]),
+                                             conversion,
+                                             fetchnator=self.fetchnator))
+
+    def _connect(self, config: dict) -> Fetchnator.Fetchnator:
+        """
+        Creates the shared Fetchnator, waiting for the API to be available instead of giving up.
+        """
+        retry_delay = 10
+        while True:
+            try:
+                daemon_logger.info("Checking if API is available")
+                # One season per library, as they take turns, plus the one being warmed up.
+                return Fetchnator.Fetchnator(
+                    cache_folder=config["cache_folder"],
+                    max_seasons=max(Fetchnator.max_seasons_in_memory, len(config["libraries"]) + 1))
+            except requests.RequestException as e:
+                daemon_logger.error(f"Could not reach the API ({e}), trying again in {retry_delay} seconds")
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, self.interval)
+
+    def run_once(self) -> None:
+        if self.warm_up_days is not None:
+            # The posters are cached per conversion, the season is shared by all of them.
+            warmed_up_conversions = []
+            for gen in self.generators:
+                if gen.convert_to not in warmed_up_conversions:
+                    gen.warm_up(self.warm_up_days)
+                    warmed_up_conversions.append(gen.convert_to)
+
+        # Round-robin, one round file per library at a time, so a big library doesn't starve the others.
+        pending = deque((gen, gen.pipeline()) for gen in self.generators)
+        while pending:
+            gen, pipeline = pending.popleft()
+            try:
+                written = next(pipeline, None)
+            except Exception:
+                # A bad library shouldn't take the others down with it, it is checked again in the next pass.
+                daemon_logger.exception(f"Failed to generate library={gen.base_folder}, skipping it for now")
+                continue
+            if written is None:
+                daemon_logger.debug(f"Library={gen.base_folder} done")
+                continue
+            daemon_logger.debug(f"Saved {written}")
+            pending.append((gen, pipeline))
+
+    def run_forever(self) -> None:
+        while True:
+            daemon_logger.info(f"Checking {len(self.generators)} libraries")
+            try:
+                self.run_once()
+            except Exception:
+                # e.g. the network is down, the next pass tries again.
+                daemon_logger.exception("Failed to check the libraries")
+            daemon_logger.info(f"Sleeping for {self.interval} seconds")
+            time.sleep(self.interval)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config",
+                        help="The daemon configuration file, with the libraries to serve.")
+    parser.add_argument("-o", "--once",
+                        action="store_true",
+                        help="Check every library once and exit, instead of running forever.")
+    parser.add_argument("-l", "--log-level",
+                        default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                        help="Set the log level")
+
+    args = parser.parse_args()
+
+    # Set logging
+    LOG_LEVEL = getattr(logging, args.log_level)
+    Fetchnator.fetchnator_logger.setLevel(LOG_LEVEL)
+    generator_logger.setLevel(LOG_LEVEL)
+    daemon_logger.setLevel(LOG_LEVEL)
+
+    with open(args.config, "r") as config_file:
+        config = json.load(config_file)
+    config.setdefault("cache_folder", os.path.join(os.path.dirname(os.path.abspath(args.config)), "cache"))
+
+    try:
+        return Daemon(config), args.once
+    except ValueError as e:
+        parser.error(f"{args.config}: {e}")
+
+
+if __name__ == '__main__':
+    daemon, once = parse_arguments()
+    if once:
+        daemon.run_once()
+    else:
+        daemon.run_forever()
@@ -15,6 +15,10 @@ import xml.etree.ElementTree as ET
 from datetime import date
 from datetime import datetime
 import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from datetime import timezone
 
 fetchnator_logger = logging.getLogger('Fetchnator')
 
@@ -22,6 +26,21 @@ module_path = inspect.getfile(inspect.currentframe())
 
 default_headers = {"User-Agent": "Formula1bot data collector py-jellyfin-metadata-generator@xinu.tv"}
 
+# Shared by everything in this process, so the connections are pooled and reused.
+http_session = requests.Session()
+
+# The schedule and the descriptions of a season still running can change, so its cache is refreshed after a week.
+current_season_cache_max_age = timedelta(days=7).total_seconds()
+
+# A season cached this long after its last race is final, Wikipedia has caught up with it by then.
+finished_season_margin = timedelta(days=7).total_seconds()
+
+# How many seasons are kept in memory by default, so a run over a huge library doesn't hold every season at once.
+max_seasons_in_memory = 4
+
+# Posters are written to disk in chunks of this size, instead of holding the whole response in memory.
+download_chunk_size = 64 * 1024
+
 
 class ImageConvertor:
     DONT = ""
@@ -54,7 +73,7 @@ database = Database()
 class RoundInfo:
 
     def __init__(self, season, f1_round, round_date, race_name, circuit_id, sprint_dateTime, fp1_dateTime, fp2_dateTime,
-                 fp3_dateTime, quali_dateTime, sprint_quali_dateTime, wiki_url):
+                 fp3_dateTime, quali_dateTime, sprint_quali_dateTime, wiki_url, race_description=None):
         """
         The parameters list here are the ones expected in the kwargs
 
@@ -69,6 +88,8 @@ class RoundInfo:
         :param fp3_dateTime: fp3 date and time, as defined in the iso8601
         :param quali_dateTime: qualification datetime, as defined in the iso8601
         :param sprint_quali_dateTime: sprint qualification datetime, as defined in the iso8601
+        :param wiki_url: the wikipedia url of the round
+        :param race_description: the round description, if None it will be fetched from wikipedia
         """
         self.season = season
         self.round = f1_round
@@ -85,10 +106,13 @@ class RoundInfo:
         self.wiki_url = wiki_url
 
         # self.race_description = wikipedia.summary(f"{season} {race_name}")
-        try:
-            self.race_description = self._get_round_info()
-        except requests.HTTPError:
-            fetchnator_logger.error(f"Could not fetch race description from wikipedia, url={self.wiki_url}")
+        self.race_description = race_description
+        if self.race_description is None:
+            try:
+                self.race_description = self._get_round_info()
+            except requests.RequestException:
+                fetchnator_logger.error(f"Could not fetch race description from wikipedia, url={self.wiki_url}")
+                self.race_description = ""
 
     def __str__(self):
         return (f"Season: {self.season}; "
@@ -103,10 +127,47 @@ class RoundInfo:
                 f"QualiDate: {self.quali_dateTime}; "
                 f"\n{self.race_description}")
 
+    def to_dict(self) -> dict:
+        """
+        :return: The round as a dict with the same keys as the constructor parameters, used by the cache.
+        """
+        return {
+            "season": self.season,
+            "f1_round": self.round,
+            "round_date": self.date,
+            "race_name": self.race_name,
+            "circuit_id": self.circuit_id,
+            "sprint_dateTime": self.sprint_dateTime,
+            "fp1_dateTime": self.fp1_dateTime,
+            "fp2_dateTime": self.fp2_dateTime,
+            "fp3_dateTime": self.fp3_dateTime,
+            "quali_dateTime": self.quali_dateTime,
+            "sprint_quali_dateTime": self.sprint_quali_dateTime,
+            "wiki_url": self.wiki_url,
+            # A description that could not be fetched is fetched again when the round is loaded from the cache.
+            "race_description": self.race_description or None,
+        }
+
+    def session_datetimes(self) -> list[datetime]:
+        """
+        :return: The datetimes of every known session of this round weekend, including the race.
+                 Dates without a time are taken as midnight UTC.
+        """
+        sessions = []
+        for session_date in [self.fp1_dateTime, self.fp2_dateTime, self.fp3_dateTime, self.sprint_quali_dateTime,
+                             self.sprint_dateTime, self.quali_dateTime, self.date]:
+            if not session_date:
+                continue
+            session_datetime = parser.isoparse(session_date)
+            if session_datetime.tzinfo is None:
+                session_datetime = session_datetime.replace(tzinfo=timezone.utc)
+            sessions.append(session_datetime)
+        return sessions
+
     def _get_round_info(self):
         fetchnator_logger.info(f"Getting data from wikipedia for round={self.round}")
 
-        response = requests.get(self.wiki_url, headers=default_headers)
+        response = http_session.get(self.wiki_url, headers=default_headers, timeout=10)
         soup = BeautifulSoup(response.text, 'html.parser')
 
         paragraphs = soup.find_all('p')
@@ -114,6 +175,13 @@ class RoundInfo:
         return '\n'.join([para.text.strip() for para in paragraphs[:2]])
 
     def to_xml(self, xml_filename, mapped_dir, round_filename, title, sort_title, aired, artwork_img_ext):
+        self.render_xml(round_filename, title, sort_title, aired, artwork_img_ext).write(
+            xml_filename, encoding="utf-8", xml_declaration=True)
+
+    def render_xml(self, round_filename, title, sort_title, aired, artwork_img_ext) -> ET.ElementTree:
+        """
+        :return: The round nfo, ready to be written. See to_xml.
+        """
         round_xml = ET.parse(f"{os.path.dirname(module_path)}/nfo-template/episode.nfo")
         round_xml.getroot().findall("./title")[0].text = title
         round_xml.getroot().findall("./sorttitle")[0].text = sort_title
@@ -125,15 +193,16 @@ class RoundInfo:
         round_xml.getroot().findall("./year")[0].text = self.season
         round_xml.getroot().findall("./art/poster")[0].text = f"metadata/{round_filename}{artwork_img_ext}"
 
-        round_xml.write(xml_filename, encoding="utf-8", xml_declaration=True)
+        return round_xml
 
-    def get_round_poster(self, filename: str, convert: str) -> None:
+    def get_round_poster(self, filename: str, convert: str, cache_folder: str | None = None) -> None:
         """
         This is a very specific function for this specific website www.eventartworks.de.
         Replace with your own if you wish.
         :param filename: The image path that should be saved, it will be in the format season_dir_path/metadata/round_name.webp
                          Example: /data/formula 1/season 2024/metadata/Formula - 1 - s2024e19 - .Round.19.USGP.Race.webp
         :param convert: To which format should it be converted to. Check ImageConvertor class.
+        :param cache_folder: If set, the poster is copied from the cache folder, fetching it there first if needed.
         """
         if convert == ImageConvertor.JPG:
             filename = os.path.splitext(filename)[0] + ".jpg"
@@ -142,6 +211,41 @@ class RoundInfo:
             fetchnator_logger.info(f"Poster already exists, no need to fetch")
             return
 
+        if cache_folder is not None:
+            cached_poster = self.cache_round_poster(cache_folder, convert)
+            if cached_poster is not None:
+                shutil.copy(cached_poster, filename)
+                return
+        elif self._download_round_poster(filename, convert):
+            return
+
+        fetchnator_logger.warning("Could not fetch round poster, using default")
+        filename = os.path.splitext(filename)[0] + ".jpg"
+        shutil.copy(f"{os.path.dirname(module_path)}/nfo-template/default_image.jpg", filename)
+
+    def cache_round_poster(self, cache_folder: str, convert: str) -> str | None:
+        """
+        Fetches the round poster into the cache folder, already converted, unless it is there already.
+        :param cache_folder: The cache folder, the poster will be saved as cache_folder/posters/sXXXXeYY.webp
+        :param convert: To which format should it be converted to. Check ImageConvertor class.
+        :return: The cached poster path, or None if it could not be fetched.
+        """
+        extension = ".jpg" if convert == ImageConvertor.JPG else ".webp"
+        filename = os.path.join(cache_folder, "posters", f"s{self.season}e{int(self.round):02d}{extension}")
+
+        if os.path.exists(filename):
+            fetchnator_logger.debug(f"Poster for season={self.season}; round={self.round} found in cache")
+            return filename
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if self._download_round_poster(filename, convert):
+            return filename
+        return None
+
+    def _download_round_poster(self, filename: str, convert: str) -> bool:
+        """
+        :return: True if the poster was saved in filename.
+        """
         round_date = datetime.strftime(parser.isoparse(self.date), "%Y-%m-%d")
 
         circuit_id = f"{round_date}-{self.circuit_id}"
@@ -152,38 +256,40 @@ class RoundInfo:
 
         fetchnator_logger.info(
             f"Getting round poster from url=https://www.eventartworks.de/images/f1@1200/{circuit_id}.webp")
-        resp = requests.get(f"https://www.eventartworks.de/images/f1@1200/{circuit_id}.webp", stream=True, headers=default_headers)
+        # Closing the response gives the connection back to the pool, even when the body is never read.
+        with http_session.get(f"https://www.eventartworks.de/images/f1@1200/{circuit_id}.webp", stream=True,
+                              headers=default_headers, timeout=10) as resp:
+            if resp.status_code != 200:
+                return False
 
-        use_default = resp.status_code != 200
-
-        if not use_default:
-            if resp.headers["Content-Type"] == "image/webp":
-                image_bytes = resp.content
-                if convert == ImageConvertor.JPG:
-                    image_bytes = ImageConvertor.convert_webp_to_jpg(resp)
-                with open(filename, "wb") as out_image:
-                    out_image.write(image_bytes)
-            else:
-                use_default = True
+            if resp.headers["Content-Type"] != "image/webp":
                 fetchnator_logger.warning(
                     f"Invalid url=https://www.eventartworks.de/images/f1@1200/{circuit_id}.webp\n"
                     f"Add to database: {circuit_id}")
+                return False
 
-        if use_default:
-            fetchnator_logger.warning("Could not fetch round poster, using default")
-            filename = os.path.splitext(filename)[0] + ".jpg"
-            shutil.copy(f"{os.path.dirname(module_path)}/nfo-template/default_image.jpg", filename)
+            # Write next to the destination first, so an interrupted run never leaves a truncated poster behind.
+            with open(f"{filename}.part", "wb") as out_image:
+                if convert == ImageConvertor.JPG:
+                    out_image.write(ImageConvertor.convert_webp_to_jpg(resp))
+                else:
+                    for chunk in resp.iter_content(chunk_size=download_chunk_size):
+                        out_image.write(chunk)
+        os.replace(f"{filename}.part", filename)
+        return True
 
 
 class Season:
-    def __init__(self, season, start_date, end_date, season_post_url):
+    def __init__(self, season, start_date, end_date, season_post_url, season_info=None):
         self.season = season
         self.start_date = start_date
         self.end_date = end_date
 
         self.season_post_url = season_post_url
 
-        self.season_info = self._get_season_info()
+        self.season_info = season_info
+        if self.season_info is None:
+            self.season_info = self._get_season_info()
 
         self.rounds = []
 
@@ -195,7 +301,34 @@ class Season:
             return None
         return self.rounds[index]
 
+    def to_dict(self) -> dict:
+        """
+        :return: The season and all its rounds as a dict, used by the cache. See from_dict.
+        """
+        return {
+            "season": self.season,
+            "start_date": self.start_date,
+            "end_date": self.end_date,
+            "season_post_url": self.season_post_url,
+            "season_info": self.season_info,
+            "rounds": [round_info.to_dict() for round_info in self.rounds],
+        }
+
+    @staticmethod
+    def from_dict(season_dict: dict) -> "Season":
+        season = Season(season_dict["season"], season_dict["start_date"], season_dict["end_date"],
+                        season_dict["season_post_url"], season_dict["season_info"])
+        for round_dict in season_dict["rounds"]:
+            season.add_round(RoundInfo(**round_dict))
+        return season
+
     def to_xml(self, filename: str, mapped_dir, artwork_img_ext):
+        self.render_xml(artwork_img_ext).write(filename, encoding="utf-8", xml_declaration=True)
+
+    def render_xml(self, artwork_img_ext) -> ET.ElementTree:
+        """
+        :return: The season nfo, ready to be written. See to_xml.
+        """
         season_xml = ET.parse(f"{os.path.dirname(module_path)}/nfo-template/season.nfo")
         season_xml.getroot().findall("./plot")[0].text = self.season_info
         season_xml.getroot().findall("./dateadded")[0].text = date.today().isoformat()
@@ -206,32 +339,66 @@ class Season:
         season_xml.getroot().findall("./seasonnumber")[0].text = self.season
         season_xml.getroot().findall("./art/poster")[0].text = f"folder{artwork_img_ext}"
 
-        season_xml.write(filename, encoding="utf-8", xml_declaration=True)
+        return season_xml
 
-    def get_season_poster(self, image_path) -> None:
+    def get_season_poster(self, image_path, cache_folder: str | None = None) -> None:
         """
         This is a function to retrieve the season's poster from an url in self.season_post_url.
         This will be saved as .jpg.
         :param image_path: Where the image should be saved. Usually season_dir_path/folder.jpg.
                            Example: /data/formula 1/season 2024/folder.jpg
+        :param cache_folder: If set, the poster is copied from the cache folder, fetching it there first if needed.
+        """
+        if cache_folder is not None:
+            cached_poster = self.cache_season_poster(cache_folder)
+            if cached_poster is not None:
+                shutil.copy(cached_poster, image_path)
+                return
+        elif self._download_season_poster(image_path):
+            return
+
+        fetchnator_logger.warning(
+            f"Could not fetch season={self.season} poster from {self.season_post_url}, using default")
+        shutil.copy(f"{os.path.dirname(module_path)}/nfo-template/default_image.jpg", image_path)
+
+    def cache_season_poster(self, cache_folder: str) -> str | None:
+        """
+        Fetches the season poster into the cache folder, unless it is there already.
+        :param cache_folder: The cache folder, the poster will be saved as cache_folder/posters/sXXXX.jpg
+        :return: The cached poster path, or None if it could not be fetched.
         """
-        use_default = self.season_post_url is None
-        if not use_default:
-            response = requests.get(self.season_post_url, headers=default_headers)
-            use_default = response.status_code != 200
-            if not use_default:
-                fetchnator_logger.info(f"Saving season={self.season} poster from {self.season_post_url}")
-                with open(f"{image_path}", 'wb') as file:
-                    file.write(response.content)
-
-        if use_default:
-            fetchnator_logger.warning(
-                f"Could not fetch season={self.season} poster from {self.season_post_url}, using default")
-            shutil.copy(f"{os.path.dirname(module_path)}/nfo-template/default_image.jpg", image_path)
+        image_path = os.path.join(cache_folder, "posters", f"s{self.season}.jpg")
+
+        if os.path.exists(image_path):
+            fetchnator_logger.debug(f"Poster for season={self.season} found in cache")
+            return image_path
+
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        if self._download_season_poster(image_path):
+            return image_path
+        return None
+
+    def _download_season_poster(self, image_path) -> bool:
+        """
+        :return: True if the poster was saved in image_path.
+        """
+        if self.season_post_url is None:
+            return False
+
+        with http_session.get(self.season_post_url, stream=True, headers=default_headers, timeout=10) as response:
+            if response.status_code != 200:
+                return False
+
+            fetchnator_logger.info(f"Saving season={self.season} poster from {self.season_post_url}")
+            with open(f"{image_path}.part", 'wb') as file:
+                for chunk in response.iter_content(chunk_size=download_chunk_size):
+                    file.write(chunk)
+        os.replace(f"{image_path}.part", image_path)
+        return True
 
     def _get_season_info(self):
         fetchnator_logger.info(f"Getting data from wikipedia for season={self.season}")
-        res = requests.get(
+        res = http_session.get(
             "https://en.wikipedia.org/w/api.php",
             params={
                 "action": "query",
@@ -255,27 +422,58 @@ class Season:
 
 
 class Fetchnator:
-    def __init__(self, api="https://api.jolpi.ca/ergast/f1"):
+    def __init__(self, api="https://api.jolpi.ca/ergast/f1", cache_folder: str | None = None,
+                 max_seasons: int = max_seasons_in_memory):
+        """
+        :param api: The ergast compatible API base url.
+        :param cache_folder: Where to keep the fetched seasons and posters between runs. None disables the cache.
+        :param max_seasons: How many seasons are kept in memory. When shared, at least one per user of this object,
+                            or they keep evicting each other's season.
+        """
         self.api_base = api
+        self.cache_folder = cache_folder
+        self.max_seasons = max_seasons
+        self.poster_data = {}
+        # season -> (Season, fetched at), so several generators sharing this object fetch each season only once.
+        # The least recently used season is dropped after max_seasons.
+        self.seasons = OrderedDict()
         # Test API connection
-        requests.get(f"{self.api_base}/2011.json", headers=default_headers).raise_for_status()
+        http_session.get(f"{self.api_base}/2011.json", headers=default_headers, timeout=10).raise_for_status()
 
         # Get season posters from thesportsdb.com
-        response = requests.get("https://www.thesportsdb.com/api/v1/json/3/search_all_seasons.php?id=4370&poster=1", headers=default_headers)
+        response = http_session.get("https://www.thesportsdb.com/api/v1/json/3/search_all_seasons.php?id=4370&poster=1", headers=default_headers,
+                                    timeout=10)
         if response.status_code == 200:
             fetchnator_logger.info("Got season posters from thesportsdb.com")
             json_data = response.json()
             self.poster_data = {item["strSeason"]: item["strPoster"] for item in json_data["seasons"] if
                                 item["strPoster"] is not None}
 
-    def get_season_info(self, year: int) -> Season:
+    def get_season_info(self, year: int, refresh: bool = False) -> Season:
+        """
+        :param year: The season year.
+        :param refresh: Ignore the cached season, if any, and fetch it again.
+        """
+        if not refresh:
+            if str(year) in self.seasons:
+                season, fetched_at = self.seasons[str(year)]
+                if self._is_season_fresh(season.end_date, fetched_at):
+                    self.seasons.move_to_end(str(year))
+                    return season
+
+            if self.cache_folder is not None:
+                season = self._load_cached_season(year)
+                if season is not None:
+                    self._remember_season(year, season, os.path.getmtime(self._season_cache_path(year)))
+                    return season
+
         def format_race_dict_date_time(race_dict: dict, key: str) -> str:
             rtn_str = f"{race_dict[key]['date']}"
             if "time" in race_dict[key]:
                 rtn_str = f"{rtn_str}T{race_dict[key]['time']}"
             return rtn_str
 
-        res = requests.get(
+        res = http_session.get(
             f"{self.api_base}/{year}.json",
             headers=default_headers,
             timeout=10
@@ -335,4 +533,50 @@ class Fetchnator:
 
             season.add_round(RoundInfo(**obj_params))
 
+        self._remember_season(year, season, time.time())
+        if self.cache_folder is not None:
+            self._save_cached_season(season)
+
         return season
+
+    def _remember_season(self, year, season: Season, fetched_at: float) -> None:
+        self.seasons[str(year)] = (season, fetched_at)
+        self.seasons.move_to_end(str(year))
+        while len(self.seasons) > self.max_seasons:
+            self.seasons.popitem(last=False)
+
+    @staticmethod
+    def _is_season_fresh(end_date: str, fetched_at: float) -> bool:
+        """
+        :param end_date: The season's last race date.
+        :param fetched_at: When the season was fetched, as a timestamp.
+        """
+        season_end = parser.isoparse(end_date).replace(tzinfo=timezone.utc).timestamp()
+        if fetched_at > season_end + finished_season_margin:
+            return True
+        return time.time() - fetched_at <= current_season_cache_max_age
+
+    def _season_cache_path(self, year) -> str:
+        return os.path.join(self.cache_folder, f"season_{year}.json")
+
+    def _load_cached_season(self, year) -> Season | None:
+        cache_path = self._season_cache_path(year)
+        if not os.path.exists(cache_path):
+            return None
+
+        with open(cache_path, "r") as cache_file:
+            season_dict = json.load(cache_file)
+
+        if not self._is_season_fresh(season_dict["end_date"], os.path.getmtime(cache_path)):
+            fetchnator_logger.debug(f"Cached season={year} is too old, fetching it again")
+            return None
+
+        fetchnator_logger.debug(f"Season={year} found in cache")
+        return Season.from_dict(season_dict)
+
+    def _save_cached_season(self, season: Season) -> None:
+        os.makedirs(self.cache_folder, exist_ok=True)
+        cache_path = self._season_cache_path(season.season)
+        with open(f"{cache_path}.part", "w") as cache_file:
+            json.dump(season.to_dict(), cache_file)
+        os.replace(f"{cache_path}.part", cache_path)
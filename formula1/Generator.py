@@ -9,209 +9,394 @@ import os
 import re
 import logging
 import inspect
+import queue
+import threading
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 from Fetchnator import Fetchnator, ImageConvertor
 
 generator_logger = logging.getLogger("Generator")
 generator_module_path = inspect.getfile(inspect.currentframe())
 
+# How many scanned round files can wait for the fetch stage before the scan stops to wait for it.
+scan_queue_size = 64
+
+
+def buffered(items, maxsize: int):
+    """
+    Iterates over items in a background thread, keeping at most maxsize of them ahead of the consumer.
+    Exceptions raised by items are raised again in the consumer.
+    """
+    buffer = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry) -> bool:
+        # Time out now and then, so the thread doesn't hang forever if the consumer stops iterating.
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+class RoundFile:
+    def __init__(self, season_dir: str, file_name: str) -> None:
+        """
+        A round file missing its metadata, filled in as it goes through the Generator pipeline.
+        :param season_dir: the season folder name, relative to the base folder
+        :param file_name: the round file name, inside the season folder
+        """
+        self.season_dir = season_dir
+        self.file_name = file_name
+        self.no_ext_name = os.path.splitext(file_name)[0]
+        # Set by the classify stage
+        self.season_number = None
+        self.round_number = None
+        self.kind = None
+        self.session = None
+        # Set by the fetch stage
+        self.round_info = None
+        # Set by the render stage
+        self.xml = None
+
+
+class SeasonFile:
+    def __init__(self, season_dir: str, season, artwork_file_name: str) -> None:
+        """
+        The metadata of a season folder that doesn't have it, sent down the Generator pipeline by the fetch stage.
+        :param season_dir: the season folder name, relative to the base folder
+        :param season: the Season
+        :param artwork_file_name: the season artwork file name, inside the season folder
+        """
+        self.season_dir = season_dir
+        self.season = season
+        self.artwork_file_name = artwork_file_name
+        # Set by the render stage
+        self.xml = None
+
 
 class Generator:
-    def __init__(self, base_folder: str, mapped_dir: str, convert: str) -> None:
+    def __init__(self, base_folder: str, mapped_dir: str, convert: str, cache_folder: str | None = None,
+                 fetchnator: Fetchnator | None = None) -> None:
+        """
+        :param fetchnator: A Fetchnator shared with other generators, cache_folder is ignored when it is given.
+        """
         self.base_folder = base_folder
         self.mapped_dir = mapped_dir
         self.convert_to = convert
-        try:
-            generator_logger.info("Checking if API is available")
-            self.fetchnator = Fetchnator()
-        except requests.HTTPError:
-            generator_logger.fatal("Could not fetch test data from API, exiting...")
-            exit(0)
+        self.fetchnator = fetchnator
+        if self.fetchnator is None:
+            try:
+                generator_logger.info("Checking if API is available")
+                self.fetchnator = Fetchnator(cache_folder=cache_folder)
+            except requests.HTTPError:
+                generator_logger.fatal("Could not fetch test data from API, exiting...")
+                exit(0)
         self.config = json.load(open(f"{os.path.dirname(generator_module_path)}/config.json", "r"))
 
+    def warm_up(self, days_ahead: int, refresh: bool = False) -> None:
+        """
+        Prefetches the current season and the posters of every round with a session in the next days_ahead days
+        into the cache folder. When the round files arrive, run() then only copies from the cache and writes the nfo.
+        :param days_ahead: How many days ahead of a round weekend it should be prefetched.
+        :param refresh: Fetch the current season again, even if the cached one is still fresh.
+        """
+        cache_folder = self.fetchnator.cache_folder
+        if cache_folder is None:
+            generator_logger.error("Warm-up needs a cache folder, skipping")
+            return
+
+        now = datetime.now(timezone.utc)
+        horizon = now + timedelta(days=days_ahead)
+        try:
+            generator_logger.info(f"Warming up season={now.year}")
+            season_obj = self.fetchnator.get_season_info(now.year, refresh=refresh)
+            season_obj.cache_season_poster(cache_folder)
+        except requests.Timeout:
+            generator_logger.error(f"Could not fetch season={now.year} from API, there was a timeout, skipping warm-up")
+            return
+        except requests.RequestException:
+            generator_logger.error(f"Could not fetch season={now.year} from API, skipping warm-up")
+            return
+
+        for s_round in season_obj.rounds:
+            sessions = s_round.session_datetimes()
+            if not sessions or max(sessions) < now or min(sessions) > horizon:
+                continue
+
+            generator_logger.info(f"Warming up season={s_round.season}; round={s_round.round} ({s_round.race_name})")
+            try:
+                if s_round.cache_round_poster(cache_folder, self.convert_to) is None:
+                    generator_logger.warning(f"Could not prefetch poster for round={s_round.round}")
+            except requests.RequestException:
+                generator_logger.error(f"Could not prefetch poster for round={s_round.round}; Skipping..")
+
     def run(self) -> None:
-        seasons = os.listdir(self.base_folder)
-        generator_logger.debug(f"Seasons folders: {seasons}")
-        for season_dir in seasons:
+        for written in self.pipeline():
+            generator_logger.debug(f"Saved {written}")
+
+    def pipeline(self):
+        """
+        Generates the missing metadata one round file at a time: scan -> classify -> fetch -> render -> write.
+        Every stage pulls from the previous one, so memory doesn't grow with the library and the first nfo is
+        written before the scan is over. The scan runs in the background, at most scan_queue_size files ahead.
+        :return: An iterator over the metadata files written.
+        """
+        return self._write(self._render(self._fetch(self._classify(buffered(self._scan(), scan_queue_size)))))
+
+    def season_dirs(self):
+        """
+        :return: An iterator over the season folder names inside the base folder.
+        """
+        with os.scandir(self.base_folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield entry.name
+
+    def _scan(self):
+        """
+        :return: An iterator over the RoundFile of each round file missing its metadata.
+        """
+        for season_dir in self.season_dirs():
+            generator_logger.info(f"Starting to check season folder={season_dir}")
             season_dir_path = os.path.join(self.base_folder, season_dir)
+            missing = False
+            with os.scandir(season_dir_path) as entries:
+                for entry in entries:
+                    if (entry.is_dir() or entry.name.endswith(self.config['metadata_extension']) or
+                            not re.findall(rf"{self.config['season_episode_format']}", entry.name,
+                                           flags=re.IGNORECASE)):
+                        continue
+                    metadata_file = f"{os.path.splitext(entry.name)[0]}{self.config['metadata_extension']}"
+                    if os.path.exists(os.path.join(season_dir_path, metadata_file)):
+                        continue
+                    generator_logger.debug(f"Round file doesn't have metadata: {entry.name}")
+                    missing = True
+                    yield RoundFile(season_dir, entry.name)
 
-            if os.path.isdir(season_dir_path):
-                generator_logger.info(f"Starting to check season folder={season_dir}")
-
-                rounds_files = os.listdir(season_dir_path)
-                # generator_logger.debug(f"Round files: {rounds_files}")
-
-                round_metadata_files = list(
-                    filter(re.compile(f".*{self.config['metadata_extension']}$").match, rounds_files))
-                rounds_files = list(set(rounds_files) - set(round_metadata_files))
-
-                # Check which round file is missing its metadata
-                round_with_missing_metadata = []
-                for round_file in rounds_files:
-                    if (not os.path.isdir(os.path.join(season_dir_path, round_file)) and
-                            re.findall(rf"{self.config['season_episode_format']}", round_file, flags=re.IGNORECASE)):
-                        if (f"{os.path.splitext(round_file)[0]}{self.config['metadata_extension']}"
-                                not in round_metadata_files):
-                            generator_logger.debug(f"Round file doesn't have metadata: {round_file}")
-                            round_with_missing_metadata.append(round_file)
-
-                if round_with_missing_metadata:
-                    generator_logger.info("There is missing metadata... fetching")
-                    # Check if there is the season metadata
-                    contains_season_metadata = "season.nfo" in round_metadata_files
-
-                    try:
-                        # doesn't matter, just get the first one to parse the season number
-                        round_file_name = round_with_missing_metadata[0]
-                        parsed_season = re.findall(rf"{self.config['season_episode_format']}",
-                                                   round_file_name,
-                                                   flags=re.IGNORECASE)
-                        if not parsed_season:
-                            generator_logger.error(
-                                f"Could not parse the season number from {round_with_missing_metadata[0]}. "
-                                f"Please check this round file. Skipping this season={season_dir}")
-
-                        parsed_season = parsed_season[0]
-                        season_number, _ = re.findall(r"[0-9]+", parsed_season)
-
-                        generator_logger.debug(f"Fetching full Season={season_number} info")
-
-                        season_obj = self.fetchnator.get_season_info(season_number)
-
-                        if not contains_season_metadata:
-                            # find season artwork
-                            artwork_file_name = list(filter(re.compile("folder.*").match, rounds_files))
-                            if not artwork_file_name:
-                                season_obj.get_season_poster(f"{season_dir_path}/folder.jpg")
-                                artwork_file_name = "folder.jpg"
-                            else:
-                                artwork_file_name = artwork_file_name[0]
-
-                            generator_logger.debug("Saving season to xml")
-                            season_obj.to_xml(f"{season_dir_path}/season{self.config['metadata_extension']}",
-                                              f"{self.mapped_dir}/{season_dir}",
-                                              os.path.splitext(artwork_file_name)[1])
-
-                    except requests.HTTPError:
-                        generator_logger.error(f"Could not fetch season={season_number} from API, skipping")
-                        break
-                    except requests.Timeout:
-                        generator_logger.error(
-                            f"Could not fetch season={season_number} from API, there was a timeout, skipping")
-                        break
+            if not missing:
+                generator_logger.info(f"No metadata missing for season={season_dir_path}")
 
-                    # Expected format <whatever> - sXXXXeYY - <whatever>
-                    for round_file_name in round_with_missing_metadata:
-                        if not os.path.isdir(f"{season_dir_path}/{round_file_name}"):
-                            parsed_season = re.findall(rf"{self.config['season_episode_format']}",
-                                                       round_file_name,
-                                                       flags=re.IGNORECASE)
-                            if not parsed_season:
-                                continue
-                            parsed_season = parsed_season[0]
-                            _, round_number = re.findall(r"[0-9]+", parsed_season)
-                            generator_logger.info(f"Processing season={season_number}; round={round_number}")
-
-                            is_sprint = re.findall(rf"{self.config['sprint']}", round_file_name, flags=re.IGNORECASE)
-                            is_sprint_quali = re.findall(rf"{self.config['sprint_quali']}", round_file_name,
-                                                         flags=re.IGNORECASE)
-                            is_quali = re.findall(rf"{self.config['quali']}", round_file_name, flags=re.IGNORECASE)
-                            is_fp1 = re.findall(rf"{self.config['fp1']}", round_file_name, flags=re.IGNORECASE)
-                            is_fp2 = re.findall(rf"{self.config['fp2']}", round_file_name, flags=re.IGNORECASE)
-                            is_fp3 = re.findall(rf"{self.config['fp3']}", round_file_name, flags=re.IGNORECASE)
-                            is_fp = re.findall(rf"{self.config['freePractice']}", round_file_name, flags=re.IGNORECASE)
-                            session = re.findall(rf"{self.config['session']}", round_file_name, flags=re.IGNORECASE)
-
-                            no_ext_round = os.path.splitext(round_file_name)[0]
-                            generator_logger.debug(f"Getting round number={int(round_number)}")
-                            s_round = season_obj.get_round(int(round_number) - 1)
-
-                            if s_round is None:
-                                generator_logger.warning(
-                                    f"Round={int(round_number)} from Season={season_number} doesn't seem to exist. "
-                                    f"Filename={round_file_name}; "
-                                    f"Please check. Skipping....")
-                                continue
-
-                            round_name = s_round.race_name
-                            round_sort = s_round.race_name + " 7"
-                            round_date = s_round.date
-
-                            if session:
-                                generator_logger.debug(f"Session {session}")
-                                session = ' '.join(session)
-                                session = re.sub(r'Part(\d)', r'Part \1', session)
-                                round_name = s_round.race_name + f" {session}"
-                                round_sort = s_round.race_name + f" {session}"
-                            elif is_sprint:
-                                generator_logger.debug("Sprint Round")
-                                round_name = s_round.race_name + " - Sprint"
-                                round_sort = s_round.race_name + " 6"
-                                round_date = s_round.sprint_dateTime
-                                # From season 2024 the sprint/sprint quali is before the quali
-                                if int(season_number) >= 2024:
-                                    round_sort = s_round.race_name + " 5"
-                            elif is_sprint_quali:
-                                generator_logger.debug("Sprint Qualification Round")
-                                round_name = s_round.race_name + " - Sprint Qualification"
-                                round_sort = s_round.race_name + " 5"
-                                round_date = s_round.sprint_dateTime
-                                # From season 2024 the sprint/sprint quali is before the quali
-                                if int(season_number) >= 2024:
-                                    round_sort = s_round.race_name + " 4"
-                            elif is_quali:
-                                generator_logger.debug("Qualification Round")
-                                round_name = s_round.race_name + " - Qualification"
-                                round_date = s_round.quali_dateTime
-                                round_sort = s_round.race_name + " 4"
-                                # From season 2024 the quali is after the sprint/sprint quali
-                                if int(season_number) >= 2024:
-                                    round_sort = s_round.race_name + " 6"
-                            elif is_fp:
-                                generator_logger.debug("Free practice round")
-                                round_name = s_round.race_name + " - Free practice"
-                                round_sort = s_round.race_name + " 0"
-                                round_date = s_round.fp1_dateTime  # will use the first practice date and time
-                            elif is_fp1:
-                                generator_logger.debug("Free practice 1 round")
-                                round_name = s_round.race_name + " - Free practice 1"
-                                round_sort = s_round.race_name + " 1"
-                                round_date = s_round.fp1_dateTime
-                            elif is_fp2:
-                                generator_logger.debug("Free practice 2 round")
-                                round_name = s_round.race_name + " - Free practice 2"
-                                round_sort = s_round.race_name + " 2"
-                                round_date = s_round.fp2_dateTime
-                            elif is_fp3:
-                                generator_logger.debug("Free practice 3 round")
-                                round_name = s_round.race_name + " - Free practice 3"
-                                round_sort = s_round.race_name + " 3"
-                                round_date = s_round.fp3_dateTime
-                            else:
-                                raise Exception(f"add a pattern to session {round_file_name}")
-
-                            if not os.path.exists(f"{season_dir_path}/metadata"):
-                                os.makedirs(f"{season_dir_path}/metadata")
-
-                            generator_logger.debug("Getting poster")
-                            try:
-                                s_round.get_round_poster(f"{season_dir_path}/metadata/{no_ext_round}.webp",
-                                                         self.convert_to)
-                            except requests.HTTPError:
-                                generator_logger.error(
-                                    f"Could not fetch round poster={season_dir_path}/metadata/{no_ext_round}.webp; "
-                                    f"Skipping..")
-
-                            img_extension = ".webp"
-                            if self.convert_to == ImageConvertor.JPG:
-                                img_extension = ".jpg"
-
-                            generator_logger.debug("Saving round to xml")
-                            s_round.to_xml(f"{season_dir_path}/{no_ext_round}{self.config['metadata_extension']}",
-                                           f"{self.mapped_dir}/{season_dir}",
-                                           no_ext_round,
-                                           round_name,
-                                           round_sort,
-                                           round_date,
-                                           img_extension)
+    def _classify(self, round_files):
+        """
+        Parses the season, the round and the session out of each round file name.
+        Expected format <whatever> - sXXXXeYY - <whatever>
+        """
+        for round_file in round_files:
+            parsed_season = re.findall(rf"{self.config['season_episode_format']}",
+                                       round_file.file_name,
+                                       flags=re.IGNORECASE)
+            if not parsed_season:
+                continue
+            round_file.season_number, round_file.round_number = re.findall(r"[0-9]+", parsed_season[0])
+
+            session = re.findall(rf"{self.config['session']}", round_file.file_name, flags=re.IGNORECASE)
+            if session:
+                round_file.kind = "session"
+                round_file.session = re.sub(r'Part(\d)', r'Part \1', ' '.join(session))
+            else:
+                # The first matching pattern wins.
+                for kind in ["sprint", "sprint_quali", "quali", "freePractice", "fp1", "fp2", "fp3"]:
+                    if re.findall(rf"{self.config[kind]}", round_file.file_name, flags=re.IGNORECASE):
+                        round_file.kind = kind
+                        break
                 else:
-                    generator_logger.info(f"No metadata missing for season={season_dir_path}")
+                    # Skipped instead of stopping, so the files after it still get their metadata.
+                    generator_logger.error(f"add a pattern to session {round_file.file_name}; Skipping..")
+                    continue
+
+            yield round_file
+
+    def _fetch(self, round_files):
+        """
+        Gets the round info and poster of each round file. Before the first round file of a season folder without its
+        metadata, a SeasonFile goes down the pipeline too.
+        """
+        failed_seasons = set()
+        for round_file in round_files:
+            season_number = round_file.season_number
+            if season_number in failed_seasons:
+                continue
+            season_dir_path = os.path.join(self.base_folder, round_file.season_dir)
+            generator_logger.info(f"Processing season={season_number}; round={round_file.round_number}")
+
+            try:
+                generator_logger.debug(f"Fetching full Season={season_number} info")
+                season_obj = self.fetchnator.get_season_info(season_number)
+
+                season_file = None
+                # The stages pull one item at a time, so the SeasonFile is written before the next file gets here.
+                if not os.path.exists(os.path.join(season_dir_path, self.config['season_metadata'])):
+                    season_file = self._fetch_season(season_obj, round_file.season_dir)
+            except requests.Timeout:
+                generator_logger.error(
+                    f"Could not fetch season={season_number} from API, there was a timeout, skipping")
+                failed_seasons.add(season_number)
+                continue
+            except requests.RequestException:
+                generator_logger.error(f"Could not fetch season={season_number} from API, skipping")
+                failed_seasons.add(season_number)
+                continue
+
+            if season_file is not None:
+                yield season_file
+
+            generator_logger.debug(f"Getting round number={int(round_file.round_number)}")
+            round_file.round_info = season_obj.get_round(int(round_file.round_number) - 1)
+
+            if round_file.round_info is None:
+                generator_logger.warning(
+                    f"Round={int(round_file.round_number)} from Season={season_number} doesn't seem to exist. "
+                    f"Filename={round_file.file_name}; "
+                    f"Please check. Skipping....")
+                continue
+
+            os.makedirs(f"{season_dir_path}/metadata", exist_ok=True)
+
+            generator_logger.debug("Getting poster")
+            try:
+                round_file.round_info.get_round_poster(f"{season_dir_path}/metadata/{round_file.no_ext_name}.webp",
+                                                       self.convert_to,
+                                                       self.fetchnator.cache_folder)
+            except requests.RequestException:
+                generator_logger.error(
+                    f"Could not fetch round poster={season_dir_path}/metadata/{round_file.no_ext_name}.webp; "
+                    f"Skipping..")
+
+            yield round_file
+
+    def _fetch_season(self, season_obj, season_dir: str) -> SeasonFile:
+        season_dir_path = os.path.join(self.base_folder, season_dir)
+
+        # find season artwork
+        artwork_file_name = None
+        with os.scandir(season_dir_path) as entries:
+            for entry in entries:
+                if entry.name.startswith("folder") and not entry.name.endswith(self.config['metadata_extension']):
+                    artwork_file_name = entry.name
+                    break
+        if artwork_file_name is None:
+            season_obj.get_season_poster(f"{season_dir_path}/folder.jpg",
+                                         self.fetchnator.cache_folder)
+            artwork_file_name = "folder.jpg"
+
+        return SeasonFile(season_dir, season_obj, artwork_file_name)
+
+    def _render(self, round_files):
+        """
+        Builds the nfo of each round file, with the title, sort title and air date of its session,
+        and of each season file.
+        """
+        img_extension = ".webp"
+        if self.convert_to == ImageConvertor.JPG:
+            img_extension = ".jpg"
+
+        for round_file in round_files:
+            if isinstance(round_file, SeasonFile):
+                round_file.xml = round_file.season.render_xml(os.path.splitext(round_file.artwork_file_name)[1])
+                yield round_file
+                continue
+
+            s_round = round_file.round_info
+            season_number = round_file.season_number
+
+            round_name = s_round.race_name
+            round_sort = s_round.race_name + " 7"
+            round_date = s_round.date
+
+            if round_file.kind == "session":
+                generator_logger.debug(f"Session {round_file.session}")
+                round_name = s_round.race_name + f" {round_file.session}"
+                round_sort = s_round.race_name + f" {round_file.session}"
+            elif round_file.kind == "sprint":
+                generator_logger.debug("Sprint Round")
+                round_name = s_round.race_name + " - Sprint"
+                round_sort = s_round.race_name + " 6"
+                round_date = s_round.sprint_dateTime
+                # From season 2024 the sprint/sprint quali is before the quali
+                if int(season_number) >= 2024:
+                    round_sort = s_round.race_name + " 5"
+            elif round_file.kind == "sprint_quali":
+                generator_logger.debug("Sprint Qualification Round")
+                round_name = s_round.race_name + " - Sprint Qualification"
+                round_sort = s_round.race_name + " 5"
+                round_date = s_round.sprint_dateTime
+                # From season 2024 the sprint/sprint quali is before the quali
+                if int(season_number) >= 2024:
+                    round_sort = s_round.race_name + " 4"
+            elif round_file.kind == "quali":
+                generator_logger.debug("Qualification Round")
+                round_name = s_round.race_name + " - Qualification"
+                round_date = s_round.quali_dateTime
+                round_sort = s_round.race_name + " 4"
+                # From season 2024 the quali is after the sprint/sprint quali
+                if int(season_number) >= 2024:
+                    round_sort = s_round.race_name + " 6"
+            elif round_file.kind == "freePractice":
+                generator_logger.debug("Free practice round")
+                round_name = s_round.race_name + " - Free practice"
+                round_sort = s_round.race_name + " 0"
+                round_date = s_round.fp1_dateTime  # will use the first practice date and time
+            elif round_file.kind == "fp1":
+                generator_logger.debug("Free practice 1 round")
+                round_name = s_round.race_name + " - Free practice 1"
+                round_sort = s_round.race_name + " 1"
+                round_date = s_round.fp1_dateTime
+            elif round_file.kind == "fp2":
+                generator_logger.debug("Free practice 2 round")
+                round_name = s_round.race_name + " - Free practice 2"
+                round_sort = s_round.race_name + " 2"
+                round_date = s_round.fp2_dateTime
+            elif round_file.kind == "fp3":
+                generator_logger.debug("Free practice 3 round")
+                round_name = s_round.race_name + " - Free practice 3"
+                round_sort = s_round.race_name + " 3"
+                round_date = s_round.fp3_dateTime
+
+            round_file.xml = s_round.render_xml(round_file.no_ext_name,
+                                                round_name,
+                                                round_sort,
+                                                round_date,
+                                                img_extension)
+            yield round_file
+
+    def _write(self, round_files):
+        """
+        Saves the nfo of each round file next to it, and of each season file in its folder.
+        :return: An iterator over the metadata files written.
+        """
+        for round_file in round_files:
+            if isinstance(round_file, SeasonFile):
+                generator_logger.debug("Saving season to xml")
+                xml_filename = os.path.join(self.base_folder, round_file.season_dir, self.config['season_metadata'])
+            else:
+                generator_logger.debug("Saving round to xml")
+                xml_filename = os.path.join(self.base_folder, round_file.season_dir,
+                                            f"{round_file.no_ext_name}{self.config['metadata_extension']}")
+            round_file.xml.write(xml_filename, encoding="utf-8", xml_declaration=True)
+            yield xml_filename
@@ -26,9 +26,19 @@ def parse_arguments():
                         default="INFO",
                         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
                         help="Set the log level")
+    parser.add_argument("--cache-folder",
+                        help="Keep the fetched seasons and posters in this folder, so they are downloaded only once.")
+    parser.add_argument("-w", "--warm-up",
+                        type=int,
+                        metavar="DAYS",
+                        help="Before generating, prefetch everything for the rounds happening in the next DAYS days. "
+                             "Needs --cache-folder.")
 
     args = parser.parse_args()
 
+    if args.warm_up is not None and args.cache_folder is None:
+        parser.error("--warm-up needs --cache-folder")
+
     # Set logging
     LOG_LEVEL = getattr(logging, args.log_level)
     Fetchnator.fetchnator_logger.setLevel(LOG_LEVEL)
@@ -41,15 +51,16 @@ def parse_arguments():
     if args.convert_to_jpg:
         conversion = Fetchnator.ImageConvertor.JPG
 
-    return Generator(args.basefolder, args.mapped_folder, conversion)
+    return Generator(args.basefolder, args.mapped_folder, conversion, args.cache_folder), args.warm_up
 
 
 if __name__ == '__main__':
     # Set to false if you want to debug stuff
     DEPLOY = True
 
+    warm_up_days = None
     if DEPLOY:
-        gen = parse_arguments()
+        gen, warm_up_days = parse_arguments()
     else:
         from Testing import GenerateTests
 
@@ -59,4 +70,7 @@ if __name__ == '__main__':
         Fetchnator.fetchnator_logger.setLevel(LOG_LEVEL)
         generator_logger.setLevel(LOG_LEVEL)
         gen = Generator("./Formula 1", "Test", Fetchnator.ImageConvertor.JPG)
+
+    if warm_up_days is not None:
+        gen.warm_up(warm_up_days)
     gen.run()